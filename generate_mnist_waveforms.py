@@ -9,10 +9,10 @@ import numpy as np
 import torch
 import random
 from torchvision import datasets, transforms
-from torch.utils.data import Subset
-import matplotlib.pyplot as plt
 import h5py
 import csv
+# njit is None without Numba; images_to_pulses then falls back to NumPy
+from waveforms import njit, prange, format_arb_samples
 
 # Set random seeds for reproducibility
 random.seed(42)
@@ -24,12 +24,19 @@ DATA_DIR = "mnist_data"
 WAVEFORM_DIR = "waveform_data/mnist"
 NUM_SAMPLES = 100  # Number of MNIST samples to convert
 BALANCED = True  # If True, select an equal number of samples from each digit
+BATCH_SIZE = 10  # Number of images converted and written to HDF5 at a time
+THRESHOLD = 0.35  # Pixel intensity (0-1) above which a pixel is "on"
+SAVE_CONCAT = False  # If True, also save all waveforms back-to-back in one CSV
+
+# Thresholded images and labels cached after the first run
+BINARY_CACHE = os.path.join(DATA_DIR, f"mnist_binary_{int(THRESHOLD * 255)}.npy")
+LABEL_CACHE = os.path.join(DATA_DIR, "mnist_labels.npy")
 
 # Define transformation for MNIST
 transform = transforms.Compose([
     transforms.Resize((28, 28)),
     transforms.ToTensor(),
-    transforms.Lambda(lambda x: (x > 0.35).float()),  # Threshold to create binary image
+    transforms.Lambda(lambda x: (x > THRESHOLD).float()),  # Threshold to create binary image
 ])
 
 # Pulse parameters
@@ -50,26 +57,187 @@ def load_mnist_dataset():
     return train_set
 
 
-def get_balanced_subset(dataset, num_samples):
-    """Select a balanced subset of the dataset with equal samples per class."""
-    targets = np.array(dataset.targets)
-    indices = []
+def binarize_images(dataset):
+    """Threshold all raw MNIST images at once.
+    
+    Works on the dataset's uint8 image tensor directly, which gives the same
+    result as the per-sample transform without a PIL decode per image.
+    
+    Returns:
+        Tuple of (binary_images, labels) with shapes (N, 28, 28) and (N,)
+    """
+    binary_images = (dataset.data.numpy() > int(THRESHOLD * 255)).astype(np.uint8)
+    labels = dataset.targets.numpy()
+    return binary_images, labels
+
+
+def load_binary_mnist():
+    """Load thresholded MNIST images and labels, using the on-disk cache.
+    
+    The first run thresholds the dataset and saves it as .npy files in
+    DATA_DIR; later runs memory-map the cached images instead.
+    
+    Returns:
+        Tuple of (binary_images, labels) with shapes (N, 28, 28) and (N,)
+    """
+    if os.path.exists(BINARY_CACHE) and os.path.exists(LABEL_CACHE):
+        print(f"Loading cached binary MNIST images from {BINARY_CACHE}...")
+        return np.load(BINARY_CACHE, mmap_mode="r"), np.load(LABEL_CACHE)
+    
+    binary_images, labels = binarize_images(load_mnist_dataset())
+    # Write each cache file under a temporary name and rename it into place,
+    # so an interrupted run never leaves a truncated cache behind
+    for cache_file, array in ((BINARY_CACHE, binary_images), (LABEL_CACHE, labels)):
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_file, cache_file)
+    return binary_images, labels
+
+
+def get_balanced_subset(targets, num_samples):
+    """Select indices of a balanced subset with equal samples per class."""
+    targets = np.asarray(targets)
     samples_per_class = num_samples // 10  # 10 digits in MNIST
     
-    for cls in range(10):
-        class_indices = np.where(targets == cls)[0]
-        selected = np.random.choice(class_indices, samples_per_class, replace=False)
-        indices.extend(selected)
+    # Group indices by class with one sort; class c occupies order[starts[c]:ends[c]]
+    order = np.argsort(targets, kind="stable")
+    counts = np.bincount(targets, minlength=10)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    
+    indices = np.concatenate([
+        np.random.choice(order[starts[cls]:ends[cls]], samples_per_class, replace=False)
+        for cls in range(10)
+    ])
     
     print(f"Selected {len(indices)} samples ({samples_per_class} per digit)")
-    return Subset(dataset, indices)
+    return indices
 
 
-def get_random_subset(dataset, num_samples):
-    """Select a random subset of the dataset."""
-    indices = np.random.choice(len(dataset), num_samples, replace=False)
+def get_random_subset(targets, num_samples):
+    """Select indices of a random subset of the dataset."""
+    indices = np.random.choice(len(targets), num_samples, replace=False)
     print(f"Selected {len(indices)} random samples")
-    return Subset(dataset, indices)
+    return indices
+
+
+def precompute_pulse_schedule(params, num_pixels=28 * 28):
+    """Compute the pulse timing shared by every image.
+    
+    Args:
+        params: Pulse parameters (see PULSE_PARAMS)
+        num_pixels: Number of pixels in each image
+        
+    Returns:
+        Tuple of (steps_on, steps_per_pixel, total_steps, time_array)
+    """
+    pixel_time = params.get("pixel_time", 5.0)  # µs
+    gap_time = params.get("gap_time", 1.0)      # µs
+    dt = params.get("dt", 1.0)                  # µs
+    
+    steps_on = int(pixel_time / dt)
+    steps_gap = int(gap_time / dt)
+    steps_per_pixel = steps_on + steps_gap
+    total_steps = num_pixels * steps_per_pixel
+    
+    # Create time array (in microseconds)
+    time_array = np.arange(total_steps, dtype=np.float32) * dt
+    
+    return steps_on, steps_per_pixel, total_steps, time_array
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _fill_pulses(images_flat, steps_on, steps_per_pixel, out):
+        """Fill out[i] with the pulse train of images_flat[i] (JIT kernel)."""
+        num_images, num_pixels = images_flat.shape
+        for n in prange(num_images * num_pixels):
+            i = n // num_pixels
+            base = (n % num_pixels) * steps_per_pixel
+            level = images_flat[i, n % num_pixels]
+            for k in range(steps_on):
+                out[i, base + k] = level
+            for k in range(steps_on, steps_per_pixel):
+                out[i, base + k] = 0
+else:
+    _fill_pulses = None
+
+
+def pulse_gap_mask(steps_on, steps_per_pixel, num_pixels):
+    """Build the 0/1 mask that zeroes the gap steps of a flattened pulse train.
+    
+    Args:
+        steps_on: Number of time steps each pixel pulse is on
+        steps_per_pixel: Number of time steps per pixel (on + gap)
+        num_pixels: Number of pixels in each image
+        
+    Returns:
+        uint8 array of length num_pixels * steps_per_pixel
+    """
+    keep = np.zeros(steps_per_pixel, dtype=np.uint8)
+    keep[:steps_on] = 1
+    return np.tile(keep, num_pixels)
+
+
+def images_to_pulses(images, steps_on, steps_per_pixel, mode="row", out=None, gap_mask=None):
+    """Convert a batch of images to pulse waveforms in one NumPy pass.
+    
+    The pulses hold the raw pixel levels in the dtype of out: uint8 by
+    default, which only fits binary (0/1) images; pass a float out array
+    for grayscale intensities. Multiply by the pulse amplitude when
+    exporting voltages.
+    
+    Args:
+        images: Array of shape (N, H, W) or (N, 1, H, W)
+        steps_on: Number of time steps each pixel pulse is on
+        steps_per_pixel: Number of time steps per pixel (on + gap)
+        mode: 'row' or 'col' for reading image pixels
+        out: Optional (N, H*W*steps_per_pixel) array to fill
+        gap_mask: Optional precomputed pulse_gap_mask for these images
+        
+    Returns:
+        Array of shape (N, H*W*steps_per_pixel), one pulse waveform per row
+    """
+    num_images = images.shape[0]
+    height, width = images.shape[-2:]
+    images = images.reshape(num_images, height, width)
+    
+    # Flatten each image (either row-wise or column-wise)
+    if mode == "col":
+        images = images.transpose(0, 2, 1)
+    images_flat = images.reshape(num_images, height * width)
+    
+    if out is None:
+        out = np.empty((num_images, height * width * steps_per_pixel), dtype=np.uint8)
+    
+    if _fill_pulses is not None:
+        _fill_pulses(np.ascontiguousarray(images_flat, dtype=out.dtype),
+                     steps_on, steps_per_pixel, out)
+    else:
+        if gap_mask is None:
+            gap_mask = pulse_gap_mask(steps_on, steps_per_pixel, height * width)
+        # Repeat each pixel over its whole slot, then zero the gaps in one contiguous pass
+        np.multiply(np.repeat(images_flat.astype(out.dtype, copy=False), steps_per_pixel, axis=1),
+                    gap_mask, out=out)
+    
+    return out
+
+
+def image_to_pulse_into(image_tensor, out_row, steps_on, steps_per_pixel, mode="row"):
+    """Write the pulse waveform of an image into a preallocated row.
+    
+    Args:
+        image_tensor: A 2D tensor representing the image
+        out_row: 1D array of length num_pixels * steps_per_pixel to fill
+            (uint8 only holds binary images; use float32 for intensities)
+        steps_on: Number of time steps each pixel pulse is on
+        steps_per_pixel: Number of time steps per pixel (on + gap)
+        mode: 'row' or 'col' for reading image pixels
+    """
+    image = image_tensor.numpy()
+    images_to_pulses(image.reshape(1, *image.shape[-2:]), steps_on, steps_per_pixel,
+                     mode=mode, out=out_row.reshape(1, -1))
 
 
 def image_to_pulse(image_tensor, **kwargs):
@@ -85,48 +253,30 @@ def image_to_pulse(image_tensor, **kwargs):
             - mode: 'row' or 'col' for reading image pixels
             
     Returns:
-        Tuple of (pulse_array, time_array)
+        Tuple of (pulse_array, time_array); pulse_array is float32 and already
+        scaled by pulse_amplitude (save_waveform_h5 stores it as is)
     """
-    # Extract parameters
-    pixel_time = kwargs.get("pixel_time", 5.0)  # µs
-    gap_time = kwargs.get("gap_time", 1.0)      # µs
-    pulse_amplitude = kwargs.get("pulse_amplitude", 1.0)
-    dt = kwargs.get("dt", 1.0)                  # µs
-    mode = kwargs.get("mode", "row")
-    
-    # Flatten the image (either row-wise or column-wise)
-    if mode == "col":
-        image_flat = image_tensor.numpy().flatten(order="F")
-    else:
-        image_flat = image_tensor.flatten().numpy()
-    
-    # Calculate steps
-    num_pixels = image_flat.shape[0]
-    steps_on = int(pixel_time / dt)
-    steps_gap = int(gap_time / dt)
-    steps_per_pixel = steps_on + steps_gap
-    total_steps = num_pixels * steps_per_pixel
+    steps_on, steps_per_pixel, total_steps, time_array = precompute_pulse_schedule(
+        kwargs, num_pixels=image_tensor.numel())
     
-    # Create pulse array
-    pulse_array = np.zeros(total_steps, dtype=np.float64)
-    for i, intensity in enumerate(image_flat):
-        start = i * steps_per_pixel
-        pulse_array[start : start + steps_on] = intensity * pulse_amplitude
-    
-    # Create time array (in microseconds)
-    time_array = np.arange(0, total_steps * dt, dt)
+    # float32, so grayscale intensities are kept and not truncated to 0/1
+    pulse_array = np.empty(total_steps, dtype=np.float32)
+    image_to_pulse_into(image_tensor, pulse_array, steps_on, steps_per_pixel,
+                        mode=kwargs.get("mode", "row"))
+    pulse_array *= kwargs.get("pulse_amplitude", 1.0)
     
     return pulse_array, time_array
 
 
-def save_waveform_csv(pulse_array, time_array, filename, sample_rate=None):
+def save_waveform_csv(pulse_array, time_array, filename, sample_rate=None, pulse_amplitude=1.0):
     """Save waveform data to CSV in a format the oscilloscope can read.
     
     Args:
-        pulse_array: Array of voltage values
+        pulse_array: Array of pulse levels (scaled by pulse_amplitude on write)
         time_array: Array of time values
         filename: Output filename
         sample_rate: Sample rate in Hz (computed from time_array if None)
+        pulse_amplitude: Amplitude of the pulse, in volts
     """
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     
@@ -136,34 +286,98 @@ def save_waveform_csv(pulse_array, time_array, filename, sample_rate=None):
         dt_sec = (time_array[1] - time_array[0]) / 1e6
         sample_rate = 1.0 / dt_sec  # Hz
     
-    with open(filename, 'w', newline='') as f:
+    with open(filename, 'w', newline='', buffering=1 << 20) as f:
         f.write(f"Rate = {sample_rate}  // Sample rate for the ARB file in Hz\n")
-        for voltage in pulse_array:
-            f.write(f"{voltage}\n")
+        f.write(format_arb_samples(pulse_array.astype(np.float32) * pulse_amplitude))
     
     print(f"Saved waveform to {filename}")
 
 
+def save_waveforms_concat_csv(pulses, filename, sample_rate, pulse_amplitude=1.0):
+    """Save several waveforms back-to-back in a single ARB CSV file.
+    
+    Uploading one file amortizes the per-transfer overhead of the VISA file
+    copy over all waveforms; waveform i starts at sample offsets[i].
+    
+    Args:
+        pulses: Array-like of shape (N, total_steps) with pulse levels
+            (an h5py dataset works too, it is read in batches)
+        filename: Output filename
+        sample_rate: Sample rate in Hz
+        pulse_amplitude: Amplitude of the pulse, in volts
+        
+    Returns:
+        Array of the starting sample offset of each waveform
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    num_waveforms, total_steps = pulses.shape
+    
+    with open(filename, 'w', newline='', buffering=1 << 20) as f:
+        f.write(f"Rate = {sample_rate}  // Sample rate for the ARB file in Hz\n")
+        for start in range(0, num_waveforms, BATCH_SIZE):
+            batch = pulses[start:start + BATCH_SIZE]
+            f.write(format_arb_samples(batch.reshape(-1).astype(np.float32) * pulse_amplitude))
+    
+    print(f"Saved {num_waveforms} concatenated waveforms to {filename}")
+    return np.arange(num_waveforms, dtype=np.int64) * total_steps
+
+
+def create_waveform_h5(filename, num_waveforms, total_steps, time_array, params, dtype="u1"):
+    """Create an HDF5 file with empty datasets sized for all waveforms.
+    
+    Pulses and labels are written into the returned file row by row, so the
+    full set of waveforms never has to be held in memory.
+    
+    Args:
+        filename: Output filename
+        num_waveforms: Number of waveforms the file will hold
+        total_steps: Number of samples per waveform
+        time_array: Time array (same for all pulses)
+        params: Parameters used to generate the pulses
+        dtype: "u1" for 0/1 pulse levels, which readers scale by the
+            dataset's pulse_amplitude attribute, or "f4" for pulses
+            already in volts
+        
+    Returns:
+        Open h5py.File with "pulses", "label" and "time" datasets
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    
+    f = h5py.File(filename, "w")
+    # One waveform per chunk, so reading a single pulse touches one chunk
+    dset = f.create_dataset("pulses", shape=(num_waveforms, total_steps), dtype=dtype,
+                            chunks=(1, total_steps), compression="lzf")
+    if np.dtype(dtype) == np.uint8:
+        # Pulses are stored as 0/1 levels; readers multiply by this on load
+        dset.attrs["pulse_amplitude"] = params.get("pulse_amplitude", 1.0)
+    f.create_dataset("label", shape=(num_waveforms,), dtype=np.int64)
+    f.create_dataset("time", data=time_array.astype(np.float32))
+    
+    # Store parameters as attributes
+    for k, v in params.items():
+        f.attrs[k] = v
+    
+    return f
+
+
 def save_waveform_h5(pulse_list, time_array, label_list, filename, params):
     """Save multiple waveforms to an HDF5 file.
     
     Args:
-        pulse_list: List of pulse arrays
+        pulse_list: List of pulse arrays, either uint8 0/1 levels (as from
+            images_to_pulses) or pulses in volts (as from image_to_pulse),
+            which are stored as float32 without rescaling
         time_array: Time array (same for all pulses)
         label_list: List of labels for each pulse
         filename: Output filename
         params: Parameters used to generate the pulses
     """
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    
-    with h5py.File(filename, "w") as f:
-        f.create_dataset("pulses", data=np.stack(pulse_list), compression="gzip")
-        f.create_dataset("time", data=time_array.astype(np.float32))
-        f.create_dataset("label", data=np.array(label_list, dtype=np.int64))
-        
-        # Store parameters as attributes
-        for k, v in params.items():
-            f.attrs[k] = v
+    levels = all(np.asarray(p).dtype == np.uint8 for p in pulse_list)
+    with create_waveform_h5(filename, len(pulse_list), len(time_array), time_array, params,
+                            dtype="u1" if levels else "f4") as f:
+        for i, pulse_array in enumerate(pulse_list):
+            f["pulses"][i] = pulse_array
+        f["label"][:] = label_list
     
     print(f"Saved {len(pulse_list)} waveforms to {filename}")
 
@@ -177,6 +391,8 @@ def plot_example_waveforms(pulse_arrays, time_array, labels, filename=None):
         labels: List of labels for each pulse
         filename: If provided, save the plot to this file
     """
+    import matplotlib.pyplot as plt
+    
     num_examples = min(5, len(pulse_arrays))
     fig, axes = plt.subplots(num_examples, 1, figsize=(10, 2*num_examples))
     
@@ -203,47 +419,66 @@ def main():
     # Create output directories
     os.makedirs(WAVEFORM_DIR, exist_ok=True)
     
-    # Load MNIST dataset
-    mnist_dataset = load_mnist_dataset()
+    # Load thresholded MNIST images (cached after the first run)
+    binary_images, labels = load_binary_mnist()
     
     # Get subset of samples
     if BALANCED:
-        subset = get_balanced_subset(mnist_dataset, NUM_SAMPLES)
+        indices = get_balanced_subset(labels, NUM_SAMPLES)
     else:
-        subset = get_random_subset(mnist_dataset, NUM_SAMPLES)
+        indices = get_random_subset(labels, NUM_SAMPLES)
     
-    # Convert images to pulses
-    pulse_arrays = []
-    label_list = []
-    time_array = None
+    # Pulse timing is the same for every image, so compute it once
+    steps_on, steps_per_pixel, total_steps, time_array = precompute_pulse_schedule(PULSE_PARAMS)
+    gap_mask = pulse_gap_mask(steps_on, steps_per_pixel, total_steps // steps_per_pixel)
     
-    print(f"Converting {len(subset)} images to waveforms...")
-    for i, (image, label) in enumerate(subset):
-        pulse_array, time_arr = image_to_pulse(image, **PULSE_PARAMS)
-        
-        if time_array is None:
-            time_array = time_arr
-        
-        pulse_arrays.append(pulse_array)
-        label_list.append(label)
+    print(f"Converting {len(indices)} images to waveforms...")
+    label_list = labels[indices].tolist()
+    num_waveforms = len(label_list)
+    
+    # Gather, convert and write one batch at a time, so each batch goes straight
+    # from the (memory-mapped) images to HDF5 and the CSV writers
+    sample_rate = 1.0 / (PULSE_PARAMS["dt"] / 1e6)  # Hz (dt is in µs)
+    pulse_amplitude = PULSE_PARAMS["pulse_amplitude"]
+    h5_filename = os.path.join(WAVEFORM_DIR, "mnist_waveforms.h5")
+    example_pulses = []
+    
+    with create_waveform_h5(h5_filename, num_waveforms, total_steps, time_array, PULSE_PARAMS) as h5_file:
+        h5_file["label"][:] = label_list
+        pulses_dset = h5_file["pulses"]
         
-        # Save individual CSV file for each waveform
-        csv_filename = os.path.join(WAVEFORM_DIR, f"mnist_digit_{label}_{i}.csv")
-        save_waveform_csv(pulse_array, time_array, csv_filename)
+        for start in range(0, num_waveforms, BATCH_SIZE):
+            stop = min(start + BATCH_SIZE, num_waveforms)
+            pulses = images_to_pulses(binary_images[indices[start:stop]], steps_on, steps_per_pixel,
+                                      mode=PULSE_PARAMS["mode"], gap_mask=gap_mask)
+            pulses_dset[start:stop] = pulses
+            
+            # Save individual CSV file for each waveform
+            for i, pulse_array in enumerate(pulses, start=start):
+                csv_filename = os.path.join(WAVEFORM_DIR, f"mnist_digit_{label_list[i]}_{i}.csv")
+                save_waveform_csv(pulse_array, None, csv_filename, sample_rate=sample_rate,
+                                  pulse_amplitude=pulse_amplitude)
+            
+            # Keep only the few waveforms needed for the example plot
+            example_pulses.extend(pulses[:5 - len(example_pulses)])
+            
+            print(f"Processed {stop}/{num_waveforms} images")
         
-        if i % 10 == 0:
-            print(f"Processed {i}/{len(subset)} images")
+        # Optionally save every waveform in one file so they can be uploaded at once
+        if SAVE_CONCAT:
+            concat_filename = os.path.join(WAVEFORM_DIR, "mnist_concat.csv")
+            h5_file["concat_offset"] = save_waveforms_concat_csv(
+                pulses_dset, concat_filename, sample_rate, pulse_amplitude)
     
-    # Save all waveforms to a single HDF5 file
-    h5_filename = os.path.join(WAVEFORM_DIR, "mnist_waveforms.h5")
-    save_waveform_h5(pulse_arrays, time_array, label_list, h5_filename, PULSE_PARAMS)
+    print(f"Saved {num_waveforms} waveforms to {h5_filename}")
     
     # Plot example waveforms
     plot_filename = os.path.join(WAVEFORM_DIR, "mnist_examples.png")
-    plot_example_waveforms(pulse_arrays, time_array, label_list, plot_filename)
+    example_pulses = np.array(example_pulses, dtype=np.float32) * pulse_amplitude
+    plot_example_waveforms(example_pulses, time_array, label_list, plot_filename)
     
     print("Done generating MNIST waveforms!")
-    print(f"Generated {len(pulse_arrays)} waveforms in '{WAVEFORM_DIR}'")
+    print(f"Generated {num_waveforms} waveforms in '{WAVEFORM_DIR}'")
     print(f"CSV files can be loaded directly into the oscilloscope's arbitrary waveform generator")
 
 
@@ -1,12 +1,11 @@
 """MXO44 Oscilloscope control module."""
-from RsInstrument import RsInstrument, BinFloatFormat
+from RsInstrument import RsInstrument
 from typing import Optional, Dict, Any, Literal, List, Tuple, Union
 from dataclasses import dataclass
-import matplotlib.pyplot as plt
 import numpy as np
-import csv
 import os
 from enum import Enum, auto
+from waveforms import format_arb_samples
 
 class WaveformType(Enum):
     """Available waveform types."""
@@ -198,46 +197,43 @@ class MXO44:
         # Enable output
         self.write(f'WGENerator1:ENABle {settings.output}')
         
-    def load_arbitrary_waveform(self, csv_file: str) -> Tuple[float, List[float]]:
+    @staticmethod
+    def _parse_arb_rate(line: str) -> Optional[float]:
+        """Return the sample rate of a 'Rate = ...' ARB header line, else None."""
+        line = line.strip()
+        if not line.startswith('Rate'):
+            return None
+        return float(line.split('=')[1].split('//')[0].strip())
+        
+    def read_arb_rate(self, csv_file: str) -> Optional[float]:
+        """Read the sample rate from an ARB CSV header, reading only the first line.
+        
+        Returns None if the file has no 'Rate = ...' header, i.e. it is not
+        in the format the instrument's ARB generator loads.
+        """
+        with open(csv_file, 'r') as f:
+            return self._parse_arb_rate(f.readline())
+        
+    def load_arbitrary_waveform(self, csv_file: str) -> Tuple[float, np.ndarray]:
         """Load arbitrary waveform data from CSV file."""
-        voltage_values = []
-        sample_rate = None
-        time_values = []
+        time_values = None
         
         with open(csv_file, 'r') as f:
-            first_line = f.readline().strip()
-            f.seek(0)
+            sample_rate = self._parse_arb_rate(f.readline())
             
-            if first_line.startswith('Rate'):
-                rate_line = f.readline().strip()
-                sample_rate = float(rate_line.split('=')[1].split('//')[0].strip())
+            if sample_rate is not None:
+                voltage_values = np.loadtxt(f, comments='//', dtype=np.float32, ndmin=1)
                 
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('//'):
-                        voltage_values.append(float(line))
-                        
             else:
-                try:
-                    reader = csv.reader(f)
-                    for row in reader:
-                        if len(row) == 2:
-                            time_values.append(float(row[0]))
-                            voltage_values.append(float(row[1]))
-                        elif len(row) == 1:
-                            voltage_values.append(float(row[0]))
-                except:
-                    f.seek(0)
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('//'):
-                            voltage_values.append(float(line))
+                f.seek(0)
+                data = np.loadtxt(f, delimiter=',', comments='//', dtype=np.float64, ndmin=2)
+                if data.shape[1] == 2:
+                    time_values = data[:, 0]
+                voltage_values = data[:, -1].astype(np.float32)
                             
         if not sample_rate:
-            if time_values:
-                time_diffs = np.diff(time_values)
-                avg_time_diff = np.mean(time_diffs)
-                sample_rate = 1 / avg_time_diff
+            if time_values is not None:
+                sample_rate = 1 / np.mean(np.diff(time_values))
             else:
                 sample_rate = 100000.0
                 
@@ -248,21 +244,30 @@ class MXO44:
         if isinstance(settings, dict):
             settings = ArbitraryWaveformSettings(**settings)
             
-        # Load waveform data
-        sample_rate, voltage_values = self.load_arbitrary_waveform(settings.csv_file)
-        if settings.sample_rate:  # Override sample rate if specified
-            sample_rate = settings.sample_rate
-            
-        # Create temporary file
-        temp_file = "temp_arb_waveform.csv"
-        with open(temp_file, 'w') as f:
-            f.write(f'Rate = {sample_rate}  // Sample rate for the ARB file\n')
-            for voltage in voltage_values:
-                f.write(f'{voltage}\n')
+        # Files already in the ARB format at the right rate are sent as is,
+        # so only their header line is read
+        file_rate = self.read_arb_rate(settings.csv_file)
+        same_rate = file_rate is not None and (
+            not settings.sample_rate or abs(settings.sample_rate - file_rate) < 1e-6)
+        
+        if same_rate:
+            sample_rate = file_rate
+            upload_file = settings.csv_file
+            temp_file = None
+        else:
+            # Load waveform data and rewrite it in the ARB format, with the
+            # requested sample rate if one is given
+            sample_rate, voltage_values = self.load_arbitrary_waveform(settings.csv_file)
+            if settings.sample_rate:
+                sample_rate = settings.sample_rate
+            temp_file = upload_file = "temp_arb_waveform.csv"
+            with open(temp_file, 'w') as f:
+                f.write(f'Rate = {sample_rate}  // Sample rate for the ARB file\n')
+                f.write(format_arb_samples(voltage_values))
         
         try:
             # Transfer file to instrument
-            self.instrument.send_file_from_pc_to_instrument(temp_file, settings.inst_file_path)
+            self.instrument.send_file_from_pc_to_instrument(upload_file, settings.inst_file_path)
             
             # Configure generator
             self.write('WGENerator1:SOURce FUNCgen')
@@ -275,7 +280,7 @@ class MXO44:
             self.write('WGENerator1:ENABle ON')
             
         finally:
-            if os.path.exists(temp_file):
+            if temp_file and os.path.exists(temp_file):
                 os.remove(temp_file)
 
     def configure_acquisition(self, settings: Union[Dict[str, Any], DataAcquisitionSettings]) -> None:
@@ -339,12 +344,12 @@ class MXO44:
         
         # Configure waveform data format for binary transfer
         self.instrument.write_str("FORMat:DATA REAL,32;:FORMat:BORDer LSBFirst")
-        self.instrument.bin_float_numbers_format = BinFloatFormat.Single_4bytes
         self.instrument.data_chunk_size = 100000  # Transfer in blocks of 100k bytes
         
         # Get waveform data
         print('Now start to transfer binary waveform data. Please wait...')
-        voltage_data = self.instrument.query_bin_or_ascii_float_list("CHAN:DATA?")
+        # Raw REAL,32 LSBFirst block, viewed in place as little-endian float32
+        voltage_data = np.frombuffer(self.instrument.query_bin_block("CHAN:DATA?"), dtype='<f4')
         
         # Get waveform parameters
         x_increment = self.query_float('TIM:SCAL?') / 10  # Time per division divided by 10
@@ -353,7 +358,7 @@ class MXO44:
         y_origin = self.query_float(f'CHAN{channel}:OFFS?')
         
         # Generate time values
-        time_data = [x_origin + i * x_increment for i in range(len(voltage_data))]
+        time_data = x_origin + np.arange(len(voltage_data), dtype=np.float64) * x_increment
         
         return {
             "time": time_data,
@@ -377,11 +382,13 @@ class MXO44:
                 f.write(f"# {key}: {value}\n")
             
             f.write("Time (s),Voltage (V)\n")
-            for t, v in zip(data["time"], data["voltage"]):
-                f.write(f"{t},{v}\n")
+            np.savetxt(f, np.column_stack([np.asarray(data["time"]), np.asarray(data["voltage"])]),
+                       fmt=('%.10g', '%.7g'), delimiter=',')
                 
     def plot_waveform(self, channel: int, filename: Optional[str] = None) -> None:
         """Plot waveform data from specified channel."""
+        import matplotlib.pyplot as plt
+        
         data = self.capture_waveform(channel)
         
         plt.figure(figsize=self.plot_settings.figure_size)
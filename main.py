@@ -5,13 +5,25 @@ from instrument import (
     DataAcquisitionSettings
 )
 import os
-from datetime import datetime
+import io
+import json
+import hashlib
+import time
 import numpy as np
 import h5py
 import random
 from pathlib import Path
+from waveforms import damped_sine, chirp, gaussian_pulse, format_arb_samples
 
-def create_example_waveform(waveform_type: str = "damped_sine") -> str:
+DATA_DIR = "waveform_data"
+
+# Bump when the generation code changes so cached example waveforms are rebuilt
+WAVEFORM_CACHE_VERSION = 2
+BLOCK_SIZE = 1 << 16  # Samples generated/written per block (64K float32 stays in L2)
+WRITE_BUFFER_SIZE = 1 << 20  # Bytes of formatted output accumulated per file write
+_RAMP_CACHE = {}  # block length -> read-only float32 sample offsets 0..n-1
+
+def create_example_waveform(waveform_type: str = "damped_sine", data_dir: str = DATA_DIR) -> str:
     """Create an example arbitrary waveform CSV file.
     
     Args:
@@ -19,49 +31,130 @@ def create_example_waveform(waveform_type: str = "damped_sine") -> str:
             - "damped_sine": Damped sine wave
             - "chirp": Frequency sweep
             - "gaussian_pulse": Gaussian pulse
+        data_dir (str): Existing directory to write the CSV file to
             
     Returns:
         str: Path to the created CSV file
     """
-    # Create data directory if it doesn't exist
-    os.makedirs("waveform_data", exist_ok=True)
-    
-    # Generate waveform data
     sample_rate = 1000000  # 1 MHz
     duration = 0.001      # 1 ms
-    t = np.linspace(0, duration, int(sample_rate * duration))
     
     if waveform_type == "damped_sine":
-        freq = 10000     # 10 kHz
-        decay = 2000     # decay factor
-        voltage = np.exp(-decay * t) * np.sin(2 * np.pi * freq * t)
-        filename = "damped_sine.csv"
-        
+        params = {"freq": 10000, "decay": 2000}  # 10 kHz, decay factor
     elif waveform_type == "chirp":
-        f0, f1 = 1000, 100000  # Frequency sweep from 1kHz to 100kHz
-        voltage = np.sin(2 * np.pi * (f0 * t + (f1 - f0) * t**2 / (2 * duration)))
-        filename = "chirp.csv"
-        
+        params = {"f0": 1000, "f1": 100000}  # Frequency sweep from 1kHz to 100kHz
     elif waveform_type == "gaussian_pulse":
-        center = duration / 2
-        width = duration / 10
-        voltage = np.exp(-(t - center)**2 / (2 * width**2))
-        filename = "gaussian_pulse.csv"
-        
+        params = {"center": duration / 2, "width": duration / 10}
     else:
         raise ValueError(f"Unknown waveform type: {waveform_type}")
     
-    # Scale voltage to be within ±1V
-    voltage = voltage / np.max(np.abs(voltage))
+    # The parameters fully determine the waveform, so reuse a previous file
+    # generated with the same ones
+    meta = {
+        "version": WAVEFORM_CACHE_VERSION,
+        "waveform_type": waveform_type,
+        "sample_rate": sample_rate,
+        "duration": duration,
+        **params,
+    }
+    key = hashlib.blake2b(json.dumps(meta, sort_keys=True).encode(), digest_size=8).hexdigest()
+    waveform_file = os.path.join(data_dir, f"{waveform_type}_{key}.csv")
+    meta_file = waveform_file + ".meta"
+    if os.path.exists(waveform_file) and os.path.exists(meta_file):
+        try:
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    return waveform_file
+        except json.JSONDecodeError:
+            pass  # Unreadable entry, regenerate it
+    
+    # Generate waveform data block by block, so the time values and kernel
+    # temporaries stay in cache; float32 is plenty for the ARB output
+    num_samples = int(sample_rate * duration)
+    dt = np.float32(1.0 / sample_rate)  # uniform 1/sample_rate steps
+    voltage = np.empty(num_samples, dtype=np.float32)
+    # One time buffer sized to the block actually used, reused for every
+    # block; the offsets it is built from are shared between calls
+    block_len = min(BLOCK_SIZE, num_samples)
+    ramp = _RAMP_CACHE.get(block_len)
+    if ramp is None:
+        ramp = np.arange(block_len, dtype=np.float32)
+        ramp.flags.writeable = False
+        _RAMP_CACHE[block_len] = ramp
+    t_buf = np.empty(block_len, dtype=np.float32)
+    
+    # Scale voltage to be within ±1V; damped sine and chirp are bounded by
+    # |sin| <= 1 already, so only the Gaussian needs its peak, which is
+    # tracked per block while the block is still in cache
+    needs_norm = waveform_type == "gaussian_pulse"
+    vmax = 0.0
+    
+    for start in range(0, num_samples, block_len):
+        stop = min(start + block_len, num_samples)
+        t = t_buf[:stop - start]
+        np.add(ramp[:stop - start], start, out=t)
+        t *= dt
+        block = voltage[start:stop]
+        if waveform_type == "damped_sine":
+            damped_sine(t, params["freq"], params["decay"], block)
+        elif waveform_type == "chirp":
+            chirp(t, params["f0"], params["f1"], duration, block)
+        else:
+            gaussian_pulse(t, params["center"], params["width"], block)
+        if needs_norm:
+            vmax = max(vmax, block.max(), -block.min())
+    
+    if needs_norm:
+        scale = np.float32(1.0 / vmax)
     
-    # Save to CSV file
-    csv_file = f"waveform_data/{filename}"
-    with open(csv_file, 'w') as f:
-        f.write(f"Rate = {sample_rate}  // Sample rate for the ARB file\n")
-        for v in voltage:
-            f.write(f"{v}\n")
+    # Save to CSV file, scaling each block just before it is formatted, plus
+    # the parameters it was generated with. Header and data are gathered in
+    # memory and handed to the file in one write, so the example waveforms
+    # cost a single syscall; larger ones are flushed every WRITE_BUFFER_SIZE
+    buf = io.BytesIO()
+    buf.write(f"Rate = {sample_rate}  // Sample rate for the ARB file\n".encode("ascii"))
+    # Both files are written under temporary names and renamed into place,
+    # so an interrupted run never leaves a truncated cache entry behind
+    tmp_file = waveform_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        for start in range(0, num_samples, BLOCK_SIZE):
+            block = voltage[start:start + BLOCK_SIZE]
+            if needs_norm:
+                block *= scale
+            buf.write(format_arb_samples(block).encode("ascii"))
+            if buf.tell() >= WRITE_BUFFER_SIZE:
+                with buf.getbuffer() as view:
+                    f.write(view)
+                buf.seek(0)
+                buf.truncate()
+        with buf.getbuffer() as view:
+            f.write(view)
+    os.replace(tmp_file, waveform_file)
+    with open(meta_file + ".tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + ".tmp", meta_file)
             
-    return csv_file
+    return waveform_file
+
+def create_example_waveforms(waveform_types=("damped_sine", "chirp", "gaussian_pulse"),
+                             data_dir: str = DATA_DIR) -> list:
+    """Create several example arbitrary waveform CSV files.
+    
+    For calibration sweeps or benchmarks that need more than one waveform.
+    Each example is only a few thousand samples and cached on disk, so they
+    are generated one after another.
+    
+    Args:
+        waveform_types: Waveform types accepted by create_example_waveform;
+            repeated types are generated once
+        data_dir (str): Directory to write the CSV files to (created if needed)
+        
+    Returns:
+        list: Paths to the created CSV files, one per distinct type, in the
+            order of waveform_types
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    return [create_example_waveform(w, data_dir) for w in dict.fromkeys(waveform_types)]
 
 def use_mnist_waveform(scope, index=None, digit=None):
     """Load a MNIST digit waveform and configure it on the oscilloscope.
@@ -77,7 +170,7 @@ def use_mnist_waveform(scope, index=None, digit=None):
     Returns:
         Tuple of (digit_label, csv_file_path) used
     """
-    mnist_dir = Path("waveform_data/mnist")
+    mnist_dir = Path(DATA_DIR) / "mnist"
     
     # Handle cases where the waveforms haven't been generated yet
     if not mnist_dir.exists():
@@ -129,15 +222,16 @@ def use_mnist_waveform(scope, index=None, digit=None):
 
 def main():
     """Test MXO44 oscilloscope control functionality."""
-    # Create instrument instance
+    # Create data directory if it doesn't exist
+    os.makedirs(DATA_DIR, exist_ok=True)
+    
+    # Create instrument instance and connect
     scope = MXO44()
+    if not scope.connect():
+        print("Failed to connect to instrument")
+        return
     
     try:
-        # Connect to instrument
-        if not scope.connect():
-            print("Failed to connect to instrument")
-            return
-            
         # Get instrument identification
         print(f"Instrument: {scope.instrument.idn_string}")
         print(f"Options: {scope.instrument.instrument_options}")
@@ -185,7 +279,7 @@ def main():
         if waveform_type == "arbitrary":
             # Create and configure arbitrary waveform
             print("\nCreating arbitrary waveform...")
-            csv_file = create_example_waveform("chirp")  # Try different waveform types
+            csv_file = create_example_waveform("chirp", DATA_DIR)  # Try different waveform types
             print(f"Created waveform file: {csv_file}")
             
             print("\nConfiguring arbitrary waveform generator...")
@@ -209,14 +303,10 @@ def main():
             )
             scope.configure_waveform_generator(wgen_settings)
         
-        # Create data directory if it doesn't exist
-        data_dir = "waveform_data"
-        os.makedirs(data_dir, exist_ok=True)
-        
         # Generate filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        csv_filename = os.path.join(data_dir, f"captured_waveform_{timestamp}.csv")
-        plot_filename = os.path.join(data_dir, f"captured_waveform_{timestamp}.png")
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        csv_filename = os.path.join(DATA_DIR, f"captured_waveform_{timestamp}.csv")
+        plot_filename = os.path.join(DATA_DIR, f"captured_waveform_{timestamp}.png")
         
         # Customize plot settings (optional)
         scope.plot_settings.figure_size = (15, 8)  # Larger plot
@@ -233,8 +323,6 @@ def main():
         print("\nPlotting captured waveform...")
         scope.plot_waveform(1, plot_filename)
         
-    except Exception as e:
-        print(f"Error: {str(e)}")
     finally:
         # Disconnect from instrument
         scope.disconnect()
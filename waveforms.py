@@ -0,0 +1,101 @@
+"""Numeric kernels for the example arbitrary waveforms.
+
+Each kernel writes its waveform for the sample times t into a preallocated
+out array. With Numba installed they are compiled with cache=True, so the
+LLVM compile cost is paid once and later runs load the cached machine code;
+without Numba they are evaluated with numexpr when it is available, and
+otherwise with the equivalent in-place NumPy expressions.
+
+format_arb_samples formats samples for the ARB CSV files written by
+main.py, instrument.py and generate_mnist_waveforms.py.
+"""
+import math
+
+import numpy as np
+
+# Optional Numba, shared with generate_mnist_waveforms.py
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; the kernels fall back to NumPy
+    njit = prange = None
+
+try:
+    import numexpr as ne
+except ImportError:  # numexpr is optional too
+    ne = None
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def damped_sine(t, freq, decay, out):
+        """Write exp(-decay*t) * sin(2π*freq*t) into out."""
+        omega = 2.0 * math.pi * freq
+        for i in prange(len(t)):
+            out[i] = np.exp(-decay * t[i]) * np.sin(omega * t[i])
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def chirp(t, f0, f1, duration, out):
+        """Write a linear f0 -> f1 frequency sweep over duration into out."""
+        # Phase 2π*(f0*t + k*t²), with 2π folded into the coefficients
+        w0 = 2.0 * math.pi * f0
+        wk = math.pi * (f1 - f0) / duration
+        for i in prange(len(t)):
+            out[i] = np.sin(t[i] * (w0 + wk * t[i]))
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def gaussian_pulse(t, center, width, out):
+        """Write a unit-height Gaussian centred at center into out."""
+        scale = -1.0 / (2.0 * width**2)
+        for i in prange(len(t)):
+            out[i] = np.exp((t[i] - center)**2 * scale)
+else:
+    def damped_sine(t, freq, decay, out):
+        """Write exp(-decay*t) * sin(2π*freq*t) into out."""
+        if ne is not None:
+            scalar = t.dtype.type
+            ne.evaluate("exp(-decay * t) * sin(omega * t)", out=out, local_dict={
+                "t": t, "decay": scalar(decay), "omega": scalar(2.0 * math.pi * freq)})
+            return
+        np.multiply(t, -decay, out=out)
+        np.exp(out, out=out)
+        phase = np.multiply(t, 2.0 * math.pi * freq)
+        np.sin(phase, out=phase)
+        out *= phase
+
+    def chirp(t, f0, f1, duration, out):
+        """Write a linear f0 -> f1 frequency sweep over duration into out."""
+        # Phase 2π*(f0*t + k*t²), with 2π folded into the coefficients
+        # so it costs no extra pass over out
+        np.multiply(t, math.pi * (f1 - f0) / duration, out=out)
+        out += 2.0 * math.pi * f0
+        out *= t
+        np.sin(out, out=out)
+
+    def gaussian_pulse(t, center, width, out):
+        """Write a unit-height Gaussian centred at center into out."""
+        if ne is not None:
+            scalar = t.dtype.type
+            ne.evaluate("exp(-((t - center)**2) * inv2w2)", out=out, local_dict={
+                "t": t, "center": scalar(center), "inv2w2": scalar(1.0 / (2 * width**2))})
+            return
+        np.subtract(t, center, out=out)
+        np.square(out, out=out)
+        out *= -1.0 / (2 * width**2)
+        np.exp(out, out=out)
+
+
+def format_arb_samples(values):
+    """Format samples as the newline-terminated value lines of an ARB CSV file.
+    
+    tolist() converts to Python floats in one C pass, so each value only
+    costs a %-format; np.savetxt and np.char.mod format per NumPy scalar.
+    
+    Args:
+        values: 1-D array of samples, in volts
+        
+    Returns:
+        str: One value per line, with a trailing newline
+    """
+    if len(values) == 0:
+        return ''
+    return '\n'.join(map('%.7g'.__mod__, values.tolist())) + '\n'